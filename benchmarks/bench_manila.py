@@ -0,0 +1,272 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Offline benchmarks for the manila charm's config rendering and status
+assessment against synthetic sets of manila-plugin backends.
+
+Run from the top of the charm (so that 'src' and 'src/lib' are on the path,
+as for the unit tests):
+
+    python3 -m benchmarks.bench_manila [--sizes 1,10,100,500] ...
+
+For each benchmark the best time per call is printed for each number of
+plugins, along with the scaling exponent between the two largest sizes
+(1.0 is linear, 2.0 is quadratic).  The exit status is 1 if any exponent
+is more than --max-exponent, so that this can be used as a gate.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import argparse
+import collections
+import itertools
+import math
+import sys
+import timeit
+
+import jinja2
+import mock
+import yaml
+
+# sets up the charmhelpers mocks and sys.path, just as for the unit tests
+import unit_tests  # noqa
+
+import charm.openstack.manila as manila
+
+
+TEMPLATES_DIR = 'src/templates/mitaka'
+CONFIG_YAML = 'src/config.yaml'
+
+# The parts included by the templates come from the openstack layer, which
+# isn't available outside of a built charm; they don't vary with the number
+# of plugins, so just provide the section headers.
+TEMPLATE_PARTS = {
+    'parts/section-database': '[database]\n',
+    'parts/section-keystone-authtoken': '[keystone_authtoken]\n',
+    'parts/section-rabbitmq-oslo': '[oslo_messaging_rabbit]\n',
+}
+
+DEFAULT_SIZES = (1, 10, 50, 100, 250, 500)
+
+
+def charm_config():
+    """Return the charm's config as hookenv.config() would on a fresh
+    deployment, i.e. the defaults from config.yaml, with a default share
+    backend so that the status check runs to completion.
+
+    :returns: {option: value}
+    """
+    with open(CONFIG_YAML) as f:
+        options = yaml.safe_load(f)['options']
+    config = {k: v.get('default') for k, v in options.items()}
+    config['default-share-backend'] = 'backend-0'
+    return config
+
+
+def plugin_configuration_data(plugins, section_lines):
+    """Return synthetic manila-plugin configuration data for `plugins`
+    backends, as get_configuration_data() provides it.
+
+    Each plugin provides its backend section, with `section_lines` lines,
+    for manila.conf, and a section for another file to check that other
+    files' data doesn't slow down the merge for manila.conf.
+
+    :param plugins: int, the number of plugins
+    :param section_lines: int, the number of lines in each section
+    :returns: (names, {plugin: {config_file: {section: lines}}})
+    """
+    names = ['backend-{}'.format(i) for i in range(plugins)]
+    config_data = {}
+    for name in names:
+        config_data[name] = {
+            manila.MANILA_CONF: {
+                '[{}]'.format(name): [
+                    'option_{} = value-{}'.format(i, name)
+                    for i in range(section_lines)],
+                'complete': True,
+            },
+            '/etc/manila/other.conf': {
+                '[{}]'.format(name): ['option = value'],
+                'complete': True,
+            },
+        }
+    return names, config_data
+
+
+def make_charm(config, plugins, section_lines):
+    """Return a ManilaCharm whose config comes from `config` and whose
+    manila-plugin relation has `plugins` synthetic backends.
+
+    :param config: {option: value}, the charm config
+    :param plugins: int, the number of plugins
+    :param section_lines: int, the number of lines in each section
+    :returns: ManilaCharm instance
+    """
+    def cf(key=None):
+        if key is not None:
+            return config[key]
+        return config
+
+    manila.hookenv.config.side_effect = cf
+    names, config_data = plugin_configuration_data(plugins, section_lines)
+    plugin_adapter = mock.MagicMock()
+    plugin_adapter.relation.names = names
+    plugin_adapter.relation.get_configuration_data.return_value = config_data
+
+    def get_adapter(state):
+        if state == manila.MANILA_PLUGIN_AVAILABLE:
+            return plugin_adapter
+        return None
+
+    c = manila.ManilaCharm()
+    c.get_adapter = get_adapter
+    # the real key comes from the reactive state, which is in unitdata
+    c._plugin_data_key = lambda: 'bench'
+    return c
+
+
+def template_env():
+    """Return a jinja2 Environment for the charm's templates.
+
+    :returns: jinja2.Environment
+    """
+    return jinja2.Environment(loader=jinja2.ChoiceLoader([
+        jinja2.DictLoader(TEMPLATE_PARTS),
+        jinja2.FileSystemLoader(TEMPLATES_DIR),
+    ]))
+
+
+def benchmarks(c, env):
+    """Return the benchmarks for charm instance `c`.
+
+    Each call is made with a new manila-plugin data key (see
+    ManilaCharm._plugin_data_key()), as if the relation had changed, so that
+    every call does the work that the first call in a hook does.
+
+    :param c: ManilaCharm instance
+    :param env: jinja2.Environment for the templates
+    :returns: [(name, callable), ...]
+    """
+    template = env.get_template('manila.conf')
+    keys = itertools.count()
+
+    def new_plugin_data_key():
+        key = 'bench-{}'.format(next(keys))
+        c._plugin_data_key = lambda: key
+
+    def config_lines_for():
+        new_plugin_data_key()
+        c.config_lines_for(manila.MANILA_CONF)
+
+    def configured_backends():
+        new_plugin_data_key()
+        c.configured_backends
+
+    def custom_assess_status_check():
+        new_plugin_data_key()
+        c.custom_assess_status_check()
+
+    def render_manila_conf():
+        new_plugin_data_key()
+        template.render(options=c.options)
+
+    return [
+        ('config_lines_for', config_lines_for),
+        ('configured_backends', configured_backends),
+        ('custom_assess_status_check', custom_assess_status_check),
+        ('render manila.conf', render_manila_conf),
+    ]
+
+
+def best_time(f, repeat, number):
+    """Return the best time, in seconds, for a single call of `f`.
+
+    :param f: callable, with no arguments
+    :param repeat: int, number of timing runs
+    :param number: int, number of calls in each run
+    :returns: float
+    """
+    return min(timeit.repeat(f, repeat=repeat, number=number)) / number
+
+
+def scaling_exponent(sizes, times):
+    """Return the exponent k such that time ~ plugins ** k between the two
+    largest sizes, or None if there aren't two sizes to compare.
+
+    :param sizes: list of ints, the number of plugins, ascending
+    :param times: list of floats, the matching times
+    :returns: float or None
+    """
+    if len(sizes) < 2 or not times[-2] or sizes[-1] == sizes[-2]:
+        return None
+    size_ratio = float(sizes[-1]) / sizes[-2]
+    return math.log(times[-1] / times[-2]) / math.log(size_ratio)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--sizes', default=','.join(str(s) for s in DEFAULT_SIZES),
+        help="comma separated numbers of plugins (default: %(default)s)")
+    parser.add_argument(
+        '--section-lines', type=int, default=100,
+        help="lines in each plugin's config section (default: %(default)s)")
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help="timing runs for each size (default: %(default)s)")
+    parser.add_argument(
+        '--number', type=int, default=5,
+        help="calls in each timing run (default: %(default)s)")
+    parser.add_argument(
+        '--max-exponent', type=float, default=1.5,
+        help="fail if any benchmark scales worse than plugins ** this "
+             "(default: %(default)s)")
+    args = parser.parse_args(argv)
+    args.sizes = sorted(int(s) for s in args.sizes.split(','))
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    config = charm_config()
+    env = template_env()
+    results = collections.OrderedDict()
+    for size in args.sizes:
+        c = make_charm(config, size, args.section_lines)
+        for name, f in benchmarks(c, env):
+            results.setdefault(name, []).append(
+                best_time(f, args.repeat, args.number))
+    failed = False
+    columns = ["{:>10}".format(s) for s in args.sizes]
+    print("{:<28}{}{:>10}".format("plugins", "".join(columns), "exponent"))
+    for name, times in results.items():
+        exponent = scaling_exponent(args.sizes, times)
+        if exponent is not None and exponent > args.max_exponent:
+            failed = True
+        columns = ["{:>10.2f}".format(t * 1000) for t in times]
+        if exponent is None:
+            columns.append("{:>10}".format('-'))
+        else:
+            columns.append("{:>10.2f}".format(exponent))
+        print("{:<28}{}".format(name, "".join(columns)))
+    print("(times in ms per call)")
+    if failed:
+        print("FAIL: scaling exponent above {}".format(args.max_exponent))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+#
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+
+# Load modules from $CHARM_DIR/lib
+sys.path.append('lib')
+
+from charms.layer import basic
+basic.bootstrap_charm_deps()
+
+import charmhelpers.core.hookenv as hookenv
+import charmhelpers.core.unitdata as unitdata
+
+import charms_openstack.charm
+
+import charm.openstack.manila as manila
+
+
+def hook_stats(*args):
+    """Return the recorded hook timing statistics as the action's 'stats'
+    result.
+    """
+    hookenv.action_set({'stats': manila.format_hook_stats()})
+
+
+def force_db_sync(*args):
+    """Sync the database, regardless of whether the charm thinks it needs to
+    be.  This can only be done on the leader.
+    """
+    if not hookenv.is_leader():
+        hookenv.action_fail("The database can only be synced on the leader")
+        return
+    with charms_openstack.charm.provide_charm_instance() as manila_charm:
+        manila_charm.db_sync(force=True)
+    hookenv.action_set({'outcome': 'database synced'})
+
+
+# Actions to function mapping, to allow for illegal python action names that
+# can map to a python function.
+ACTIONS = {
+    'hook-stats': hook_stats,
+    'force-db-sync': force_db_sync,
+}
+
+
+def main(args):
+    action_name = os.path.basename(args[0])
+    try:
+        action = ACTIONS[action_name]
+    except KeyError:
+        return "Action {} undefined".format(action_name)
+    else:
+        try:
+            action(args)
+        except Exception as e:
+            hookenv.action_fail(str(e))
+        else:
+            # Actions don't go through the reactive main(), so nothing else
+            # runs the atexit callbacks or commits the unit's kv store.
+            hookenv._run_atexit()
+            unitdata.kv().flush()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -17,29 +17,206 @@
 # needed on the class.
 from __future__ import absolute_import
 
+import collections
+import contextlib
+import hashlib
+import json
+import multiprocessing
+import os
 import re
 import subprocess
+import time
 
 import charmhelpers.core.hookenv as hookenv
+import charmhelpers.core.host as ch_host
+import charmhelpers.core.templating as ch_templating
+import charmhelpers.core.unitdata as unitdata
+import charmhelpers.contrib.hahelpers.cluster as ch_cluster
+import charmhelpers.contrib.openstack.templating as os_templating
+import charmhelpers.contrib.openstack.utils as ch_utils
+import charmhelpers.fetch as fetch
+
+import charms.reactive
 
 import charms_openstack.charm
 import charms_openstack.adapters
 import charms_openstack.ip as os_ip
 
+import charm.openstack.update_status as update_status
+
 # note that manila-common is pulled in via the other packages.
 PACKAGES = ['manila-api',
             'manila-data',
             'manila-scheduler',
             'manila-share',
             'python-pymysql',
+            'python-memcache',  # for the keystone_authtoken token cache
             'python-apt',  # for subordinate neutron-openvswitch if needed.
             ]
 
+# The roles that a unit can be deployed as.  Each role is the manila-<role>
+# package and service; a unit can have any combination of the roles.
+ROLES = ('api', 'scheduler', 'share', 'data')
+
+MANILA_API_PORT = 8786
+
+# rabbitmq's port when the amqp relation doesn't offer SSL
+AMQP_DEFAULT_PORT = 5672
+
 MANILA_DIR = '/etc/manila/'
 MANILA_CONF = MANILA_DIR + "manila.conf"
 MANILA_LOGGING_CONF = MANILA_DIR + "logging.conf"
 MANILA_API_PASTE_CONF = MANILA_DIR + "api-paste.ini"
 
+# When 'use-wsgi' is set, manila-api is served by apache2 + mod_wsgi rather
+# than the standalone eventlet daemon.
+WSGI_PACKAGES = ['apache2', 'libapache2-mod-wsgi']
+MANILA_WSGI_SCRIPT = "/usr/share/manila/manila-api.wsgi"
+MANILA_API_SITE = 'manila-api'
+MANILA_API_VHOST_CONF = "/etc/apache2/sites-available/manila-api.conf"
+MANILA_API_VHOST_ENABLED = "/etc/apache2/sites-enabled/manila-api.conf"
+
+# The optional filters that the 'api-middleware' option can add to the manila
+# API pipelines in api-paste.ini, mapped to where they go: 'outer' filters go
+# straight after cors so that they wrap all of the request handling, 'inner'
+# filters need the request context and so go after the auth filters.
+API_MIDDLEWARE = collections.OrderedDict([
+    ('timing', 'outer'),
+    ('osprofiler', 'outer'),
+    ('gzip', 'outer'),
+    ('ratelimit', 'inner'),
+])
+
+# The 'timing' filter is a module that the charm installs; see
+# templates/manila_charm_request_timing.py
+MANILA_REQUEST_TIMING_MODULE = ('/usr/lib/python2.7/dist-packages/'
+                                'manila_charm_request_timing.py')
+
+# The 'osprofiler' filter needs osprofiler, and the HMAC key that signs the
+# trace requests is generated by the leader and kept in this leader setting.
+PROFILER_PACKAGES = ['python-osprofiler']
+PROFILER_HMAC_KEY = 'profiler-hmac-key'
+
+# The API filters that only work from a later release than the charm's first,
+# and that release.  Before ocata manila never initialises the osprofiler
+# notifier, so the filter would accept trace requests but report nothing.
+API_MIDDLEWARE_RELEASES = {
+    'osprofiler': 'ocata',
+}
+
+# The levels that the 'log-level-*' options can be set to.
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+
+# When 'use-local-memcache' is set, a memcached is run on the unit for the
+# keystone_authtoken token cache.
+LOCAL_MEMCACHE_PACKAGES = ['memcached']
+LOCAL_MEMCACHE_SERVER = '127.0.0.1:11211'
+
+# The state that the manila-plugin interface sets when backend configuration
+# is available.
+MANILA_PLUGIN_AVAILABLE = 'manila-plugin.available'
+
+# A manila-plugin backend can ask for extra scheduler filters by including a
+# list of filter names under this key in its configuration data.
+PLUGIN_SCHEDULER_FILTERS_KEY = 'scheduler-filters'
+
+# A manila-plugin backend can ask to be run in its own manila-share process
+# by setting this key to True in its configuration data; the
+# 'share-process-per-backend' option does this for every backend.
+PLUGIN_ISOLATED_PROCESS_KEY = 'isolated-share-process'
+
+# Isolated backends are run by instances of this systemd template unit, each
+# with an extra config file that enables just that backend.
+MANILA_SHARE_INSTANCE = 'manila-share@{}'
+MANILA_SHARE_UNIT = '/etc/systemd/system/manila-share@.service'
+MANILA_SHARE_BACKENDS_DIR = MANILA_DIR + 'manila-share.d/'
+MANILA_SHARE_UNIT_CONTENT = """\
+[Unit]
+Description=OpenStack Manila Share Server (%i backend)
+After=network.target
+
+[Service]
+User=manila
+Group=manila
+ExecStart=/usr/bin/manila-share --config-file={conf} \\
+    --config-file={backends_dir}%i.conf \\
+    --log-file=/var/log/manila/manila-share-%i.log
+Restart=on-failure
+
+[Install]
+WantedBy=multi-user.target
+""".format(conf=MANILA_CONF, backends_dir=MANILA_SHARE_BACKENDS_DIR)
+
+# manila's (mitaka) scheduler_default_filters; used as the base list when a
+# plugin adds filters but the 'scheduler-default-filters' option isn't set.
+MANILA_DEFAULT_SCHEDULER_FILTERS = ['AvailabilityZoneFilter',
+                                    'CapacityFilter',
+                                    'CapabilitiesFilter',
+                                    'ConsistencyGroupFilter',
+                                    'ShareReplicationFilter']
+
+# The oslo.messaging notification drivers that the charm supports.
+NOTIFICATION_DRIVERS = ('noop', 'messaging', 'messagingv2', 'log')
+
+# unitdata key for the roles whose services were paused because the unit no
+# longer has them; see ManilaCharm.configure_roles()
+PAUSED_ROLES_KEY = 'manila.paused-roles'
+
+# unitdata key for the hashes of the rendered configuration files as of the
+# last time the services that use them were restarted.
+RENDERED_HASHES_KEY = 'manila.rendered-hashes'
+
+# Changes to these options, per file, can be picked up by reloading (SIGHUP)
+# the services that use the file rather than restarting them.  None means
+# that the whole file can be reloaded.  This is only the case from
+# MUTABLE_OPTIONS_RELEASE, when the manila services mutate their config on
+# SIGHUP, which re-applies 'debug' and re-reads the logging config; before
+# that nothing is re-applied, so every change needs a restart.  The charm only
+# has mitaka templates so far, so for now every change is a restart.
+MUTABLE_OPTIONS = {
+    MANILA_CONF: ('debug', ),
+    MANILA_LOGGING_CONF: None,
+}
+MUTABLE_OPTIONS_RELEASE = 'queens'
+
+# The relations whose data can go into the rendered configuration, and the
+# reactive data_changed() key for the fingerprint of everything that does;
+# see ManilaCharm.render_fingerprint()
+RENDER_RELATIONS = ('shared-db', 'identity-service', 'amqp',
+                    'amqp-notifications', 'manila-plugin', 'memcache',
+                    'cluster', 'ha')
+RENDER_FINGERPRINT_KEY = 'manila.render-fingerprint'
+# The charm directories whose contents go into the fingerprint; see
+# charm_files_hash()
+CHARM_FILES_TREES = ('lib', 'reactive', 'templates')
+
+# unitdata key for the hook timing statistics; see record_timing()
+HOOK_STATS_KEY = 'manila.hook-stats'
+HOOK_STATS_METRIC_PREFIX = 'manila_charm'
+
+# The manila alembic migrations, used to find the schema head that the
+# installed manila expects.
+MANILA_ALEMBIC_VERSIONS_DIR = ('/usr/lib/python2.7/dist-packages/manila/db/'
+                               'migrations/alembic/versions')
+# leader setting that records what the database was last synced for
+DB_SYNC_KEY = 'manila-db-sync'
+
+# When doing rolling restarts, how long to wait (in seconds) for a service to
+# be running again before moving on to the next one.
+ROLLING_RESTART_TIMEOUT = 30
+
+# Worker sizing: if 'worker-multiplier' isn't set then use this multiplier,
+# and, when running in a container, cap the worker count at
+# MAX_DEFAULT_WORKERS so that co-located containers don't swamp the host.
+DEFAULT_WORKER_MULTIPLIER = 2.0
+MAX_DEFAULT_WORKERS = 4
+
+# oslo.db (SQLAlchemy) connection pool defaults, used unless the pool sizes
+# are set.  These are per process: every API worker, and the scheduler, share
+# and data services, has its own pool, which its greenthreads share.
+DEFAULT_DB_MAX_POOL_SIZE = 5
+DEFAULT_DB_MAX_OVERFLOW = 10
+
 # select the default release function and ssl feature
 charms_openstack.charm.use_defaults('charm.default-select-release')
 
@@ -57,19 +234,308 @@ def strip_join(s, divider=" "):
         re.split(r'\s+', re.sub(r'([^\s\w-])+', '', (s or ""))))
 
 
+def calculate_workers(multiplier, cpus, in_container=False):
+    """Calculate the number of workers for a service from the number of cpus
+    and the configured multiplier.
+
+    If the multiplier is not set (None or 0) then DEFAULT_WORKER_MULTIPLIER is
+    used and, if the unit is in a container, the result is capped to
+    MAX_DEFAULT_WORKERS.  An explicitly set multiplier is never capped.  There
+    is always at least one worker.
+
+    :param multiplier: float or None, the 'worker-multiplier' config value
+    :param cpus: int, the number of cpus available to the unit
+    :param in_container: boolean, True if the unit is in a container
+    :returns: int, the number of workers
+    """
+    if not multiplier:
+        count = int(cpus * DEFAULT_WORKER_MULTIPLIER)
+        if in_container:
+            count = min(count, MAX_DEFAULT_WORKERS)
+    else:
+        count = int(cpus * multiplier)
+    return max(count, 1)
+
+
+def config_hashes(path, mutable_options=None):
+    """Hash the configuration file at path for deciding whether the services
+    that use it need to be restarted or just reloaded.
+
+    The 'full' hash covers the whole file.  The 'restart' hash ignores the
+    lines that set the file's mutable options, so if only the 'full' hash
+    changes then a reload is sufficient.
+
+    :param path: string, the configuration file
+    :param mutable_options: {path: options}, as MUTABLE_OPTIONS, for the
+        release; defaults to none, i.e. the 'restart' hash covers everything
+    :returns: {'full': hash or None, 'restart': hash or None}, None if the
+        file doesn't exist.
+    """
+    if not os.path.exists(path):
+        return {'full': None, 'restart': None}
+    with open(path, 'rb') as f:
+        content = f.read()
+    mutable = (mutable_options or {}).get(path, ())
+    if mutable is None:
+        restart_content = b''
+    elif mutable:
+        matcher = re.compile(r'^\s*({})\s*='.format(
+            '|'.join(re.escape(o) for o in mutable)).encode())
+        restart_content = b'\n'.join(
+            line for line in content.splitlines()
+            if not matcher.match(line))
+    else:
+        restart_content = content
+    return {
+        'full': hashlib.sha256(content).hexdigest(),
+        'restart': hashlib.sha256(restart_content).hexdigest(),
+    }
+
+
+def per_plugin_config_data(config_data):
+    """Return the configuration data from the manila-plugin relation keyed by
+    plugin name.
+
+    The data is {plugin: {config_file: {section: lines, 'complete': bool}}}.
+    Older versions of the interface provide a single plugin's data as
+    {config_file: {section: lines, 'complete': bool}}; this is returned as
+    the data for a single plugin with the name ''.
+
+    :param config_data: the data from get_configuration_data()
+    :returns: {plugin: {config_file: {section: lines, 'complete': bool}}}
+    """
+    if any(isinstance(v, dict) and 'complete' in v
+           for v in config_data.values()):
+        return {'': config_data}
+    return config_data
+
+
+def record_timing(kind, name, seconds):
+    """Record the wall clock time taken by something the charm did.
+
+    The last, total and count of the timings are kept in unitdata for each
+    kind ('handler', 'charm', 'template' or 'subprocess') and name, and, at the
+    end of the hook, written to the 'hook-stats-textfile' for the prometheus
+    node exporter's textfile collector.
+
+    :param kind: string, the kind of thing that was timed
+    :param name: string, the name of the thing that was timed
+    :param seconds: float, the time it took
+    """
+    kv = unitdata.kv()
+    stats = kv.get(HOOK_STATS_KEY) or {}
+    entry = stats.setdefault(kind, {}).setdefault(
+        name, {'last': 0.0, 'total': 0.0, 'count': 0})
+    entry['last'] = seconds
+    entry['total'] += seconds
+    entry['count'] += 1
+    kv.set(HOOK_STATS_KEY, stats)
+    global _hook_stats_textfile_pending
+    if not _hook_stats_textfile_pending:
+        _hook_stats_textfile_pending = True
+        hookenv.atexit(write_hook_stats_textfile)
+
+
+_hook_stats_textfile_pending = False
+
+
+@contextlib.contextmanager
+def timed(kind, name):
+    """Context manager that records (see record_timing()) how long the code
+    in the context took, even if it raises.
+
+    Note that the reactive handlers use this rather than a decorator, as
+    charms.reactive identifies handlers by their code object.
+
+    :param kind: string, the kind of thing that is being timed
+    :param name: string, the name of the thing that is being timed
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        record_timing(kind, name, time.time() - start)
+
+
+def timed_check_call(cmd):
+    """subprocess.check_call() the command, recording how long it took.
+
+    :param cmd: list of strings, the command to run
+    """
+    with timed('subprocess', ' '.join(cmd)):
+        subprocess.check_call(cmd)
+
+
+def format_hook_stats(stats=None):
+    """Format the hook timing statistics in the prometheus text exposition
+    format.
+
+    :param stats: the statistics as recorded by record_timing(), or None to
+        read them from unitdata
+    :returns: string
+    """
+    if stats is None:
+        stats = unitdata.kv().get(HOOK_STATS_KEY) or {}
+
+    def _escape(value):
+        return (value.replace('\\', '\\\\')
+                .replace('"', '\\"')
+                .replace('\n', '\\n'))
+
+    lines = []
+    for kind in sorted(stats.keys()):
+        for metric, field, metric_type, help_text in (
+                ('last_seconds', 'last', 'gauge',
+                 'Wall clock time of the last run'),
+                ('seconds_total', 'total', 'counter',
+                 'Total wall clock time of all runs'),
+                ('runs_total', 'count', 'counter',
+                 'Number of runs')):
+            metric_name = '{}_{}_{}'.format(
+                HOOK_STATS_METRIC_PREFIX, kind, metric)
+            lines.append('# HELP {} {} of each charm {}.'
+                         .format(metric_name, help_text, kind))
+            lines.append('# TYPE {} {}'.format(metric_name, metric_type))
+            for name in sorted(stats[kind].keys()):
+                lines.append('{}{{name="{}"}} {}'.format(
+                    metric_name, _escape(name), stats[kind][name][field]))
+    return '\n'.join(lines) + '\n'
+
+
+def write_hook_stats_textfile():
+    """Write the hook timing statistics to the 'hook-stats-textfile', if it is
+    set and its directory exists (i.e. the node exporter is installed).  The
+    file is replaced atomically so that the collector never reads a partial
+    file.
+    """
+    global _hook_stats_textfile_pending
+    _hook_stats_textfile_pending = False
+    path = hookenv.config().get('hook-stats-textfile')
+    if not path or not os.path.isdir(os.path.dirname(path)):
+        return
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(format_hook_stats())
+    os.rename(tmp_path, path)
+
+
+def write_file_if_changed(path, content):
+    """Write content to path, atomically, unless the file already has that
+    content.
+
+    :param path: string, the file to write
+    :param content: string, the content of the file
+    :returns: boolean: True if the file was written
+    """
+    try:
+        with open(path) as f:
+            if f.read() == content:
+                return False
+    except (IOError, OSError):
+        pass
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.rename(tmp_path, path)
+    return True
+
+
+def charm_files_hash():
+    """Return a hash of the charm's code and templates, so that an upgraded
+    charm is seen as a change by the render fingerprint.
+
+    :returns: string
+    """
+    paths = []
+    for tree in CHARM_FILES_TREES:
+        top = os.path.join(hookenv.charm_dir(), tree)
+        for root, dirs, files in os.walk(top):
+            dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+            paths.extend(os.path.join(root, f) for f in sorted(files)
+                         if not f.endswith('.pyc'))
+    h = hashlib.sha256()
+    for path in paths:
+        h.update(path.encode('UTF-8'))
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def alembic_heads(versions_dir=MANILA_ALEMBIC_VERSIONS_DIR):
+    """Return the head revision(s) of the alembic migrations in versions_dir.
+
+    This parses the migration scripts rather than importing alembic, as the
+    charm doesn't run in manila's python.
+
+    :param versions_dir: string, the alembic versions directory
+    :returns: sorted list of strings: the head revisions, [] if there are no
+        migrations
+    """
+    revision_re = re.compile(r'^revision\s*=\s*[\'"]([^\'"]+)[\'"]', re.M)
+    down_revision_re = re.compile(r'^down_revision\s*=\s*(.*)$', re.M)
+    revisions = set()
+    down_revisions = set()
+    try:
+        filenames = os.listdir(versions_dir)
+    except OSError:
+        return []
+    for filename in filenames:
+        if not filename.endswith('.py'):
+            continue
+        with open(os.path.join(versions_dir, filename)) as f:
+            content = f.read()
+        revision = revision_re.search(content)
+        if revision is None:
+            continue
+        revisions.add(revision.group(1))
+        down_revision = down_revision_re.search(content)
+        if down_revision is not None:
+            down_revisions.update(
+                re.findall(r'[\'"]([^\'"]+)[\'"]', down_revision.group(1)))
+    return sorted(revisions - down_revisions)
+
+
+def relation_units(relation_name):
+    """Return all of the remote units on all of the relations of
+    relation_name.
+
+    :param relation_name: string, the relation name
+    :returns: sorted list of strings: the unit names
+    """
+    return sorted(unit
+                  for rid in hookenv.relation_ids(relation_name)
+                  for unit in hookenv.related_units(rid))
+
+
+def installed_version(package):
+    """Return the installed version of the package, or None if it isn't
+    installed.
+
+    :param package: string, the package name
+    :returns: string or None
+    """
+    try:
+        return subprocess.check_output(
+            ['dpkg-query', '-W', '-f=${Version}', package]).decode('UTF-8')
+    except subprocess.CalledProcessError:
+        return None
+
+
 ###
 # Compute some options to help with template rendering
 @charms_openstack.adapters.config_property
 def computed_share_backends(config):
     """Determine the backend protocols that are provided as a string.
 
-    This asks the charm class what the backend protocols are, and then provides
-    it as a space separated list of backends.
+    This asks the charm class what the backends run by the main manila-share
+    service are, and then provides it as a space separated list of backends.
+    Backends run in their own process are enabled by that process's extra
+    config file; see ManilaCharm.configure_share_processes().
 
     :param config: the config option on which to look up config options
     :returns: string
     """
-    return ' '.join(config.charm_instance.configured_backends)
+    return ' '.join(config.charm_instance.main_share_backends)
 
 
 @charms_openstack.adapters.config_property
@@ -96,17 +562,193 @@ def computed_backend_lines_manila_conf(config):
 
 @charms_openstack.adapters.config_property
 def computed_debug_level(config):
-    """Return NONE, INFO, WARNING, DEBUG depending on the settings of
-    options.debug and options.level
-    :returns: string, NONE, WARNING, DEBUG
+    """Return the level for the manila loggers in logging.conf depending on
+    the settings of options.debug and options.verbose, as oslo.log does.
+
+    :returns: string, DEBUG, INFO or WARNING
     """
-    if not config.debug:
-        return "NONE"
-    if config.verbose:
+    if config.debug:
         return "DEBUG"
+    if config.verbose:
+        return "INFO"
     return "WARNING"
 
 
+@charms_openstack.adapters.config_property
+def computed_log_handler(config):
+    """Return the logging.conf handler for the manila loggers: 'buffer' if
+    'log-buffer-capacity' is set, otherwise 'stderr'.
+
+    :param config: the config option on which to look up config options
+    :returns: string
+    """
+    if config.log_buffer_capacity:
+        return "buffer"
+    return "stderr"
+
+
+@charms_openstack.adapters.config_property
+def computed_api_workers(config):
+    """Return the number of osapi_share workers for the manila-api service.
+
+    :param config: the config option on which to look up config options
+    :returns: int
+    """
+    return config.charm_instance.api_workers
+
+
+@charms_openstack.adapters.config_property
+def computed_database_max_pool_size(config):
+    """Return the [database] max_pool_size.  If 'database-max-pool-size' is
+    not set then it is derived from the API worker count.
+
+    :param config: the config option on which to look up config options
+    :returns: int
+    """
+    return config.charm_instance.db_pool_settings['max_pool_size']
+
+
+@charms_openstack.adapters.config_property
+def computed_database_max_overflow(config):
+    """Return the [database] max_overflow.  If 'database-max-overflow' is not
+    set then it is derived from the API worker count.
+
+    :param config: the config option on which to look up config options
+    :returns: int
+    """
+    return config.charm_instance.db_pool_settings['max_overflow']
+
+
+@charms_openstack.adapters.config_property
+def computed_scheduler_default_filters(config):
+    """Return the scheduler filters as a comma separated list, including any
+    requested by the manila-plugin backends, or the empty string to use
+    manila's default filters.
+
+    :param config: the config option on which to look up config options
+    :returns: string
+    """
+    return ','.join(config.charm_instance.scheduler_filters)
+
+
+@charms_openstack.adapters.config_property
+def computed_scheduler_default_weighers(config):
+    """Return the scheduler weighers as a comma separated list, or the empty
+    string to use manila's default weighers.
+
+    :param config: the config option on which to look up config options
+    :returns: string
+    """
+    return ','.join((config.scheduler_default_weighers or '')
+                    .replace(',', ' ').split())
+
+
+@charms_openstack.adapters.config_property
+def computed_rabbit_queue_options(config):
+    """Return the [oslo_messaging_rabbit] queue option lines for the
+    'rabbit-durable-queues' and 'rabbit-ha-queues' options that are set.
+    Unset options are left to the section-rabbitmq-oslo part, which turns on
+    HA queues for a clustered rabbitmq; as oslo.config takes the last value,
+    rendering them regardless would override it.
+
+    :param config: the config option on which to look up config options
+    :returns: list of strings: 'option = value' lines
+    """
+    lines = []
+    for option in ('rabbit_durable_queues', 'rabbit_ha_queues'):
+        value = getattr(config, option, None)
+        if value is not None:
+            lines.append("{} = {}".format(option, value))
+    return lines
+
+
+@charms_openstack.adapters.config_property
+def computed_notification_transport_url(config):
+    """Return the transport_url for notifications if they are sent over the
+    separate 'amqp-notifications' relation, otherwise the empty string.
+
+    :param config: the config option on which to look up config options
+    :returns: string
+    """
+    return config.charm_instance.notification_transport_url
+
+
+@charms_openstack.adapters.config_property
+def computed_memcache_servers(config):
+    """Return the memcached servers for the keystone_authtoken token cache as a
+    comma separated list of host:port, or the empty string if there are none.
+
+    :param config: the config option on which to look up config options
+    :returns: string
+    """
+    return ','.join(config.charm_instance.memcache_servers)
+
+
+@charms_openstack.adapters.config_property
+def computed_api_outer_filters(config):
+    """Return the optional 'outer' API filters (see API_MIDDLEWARE) for the
+    api-paste.ini pipelines, each followed by a space so that the result can
+    be placed directly before the next filter.  osprofiler is left out until
+    its HMAC key is available.
+
+    :param config: the config option on which to look up config options
+    :returns: string
+    """
+    charm_instance = config.charm_instance
+    filters = [m for m in charm_instance.api_middleware
+               if API_MIDDLEWARE[m] == 'outer']
+    if 'osprofiler' in filters and not charm_instance.profiler_hmac_key:
+        filters.remove('osprofiler')
+    return ''.join('{} '.format(m) for m in filters)
+
+
+@charms_openstack.adapters.config_property
+def computed_api_inner_filters(config):
+    """Return the optional 'inner' API filters (see API_MIDDLEWARE) for the
+    api-paste.ini pipelines, each followed by a space so that the result can
+    be placed directly before the API app.
+
+    :param config: the config option on which to look up config options
+    :returns: string
+    """
+    return ''.join('{} '.format(m)
+                   for m in config.charm_instance.api_middleware
+                   if API_MIDDLEWARE[m] == 'inner')
+
+
+@charms_openstack.adapters.config_property
+def computed_profiler_hmac_key(config):
+    """Return the osprofiler HMAC key, or the empty string if osprofiler isn't
+    enabled (or the key isn't available yet).
+
+    :param config: the config option on which to look up config options
+    :returns: string
+    """
+    return config.charm_instance.profiler_hmac_key or ''
+
+
+@charms_openstack.adapters.config_property
+def computed_api_listen_port(config):
+    """Return the port that the manila-api service (either the eventlet daemon
+    or the apache2 vhost) listens on.
+
+    :param config: the config option on which to look up config options
+    :returns: int
+    """
+    return config.charm_instance.api_listen_port
+
+
+@charms_openstack.adapters.config_property
+def computed_wsgi_processes(config):
+    """Return the number of mod_wsgi daemon processes for manila-api.  If
+    'wsgi-processes' is not set then the api worker count is used.
+
+    :param config: the config option on which to look up config options
+    :returns: int
+    """
+    return config.wsgi_processes or config.charm_instance.api_workers
+
+
 ###
 # Implementation of the Manila Charm classes
 
@@ -117,52 +759,545 @@ class ManilaCharm(charms_openstack.charm.HAOpenStackCharm):
 
     release = 'mitaka'
     name = 'manila'
-    packages = PACKAGES
-    api_ports = {
-        'manila-api': {
-            os_ip.PUBLIC: 8786,
-            os_ip.ADMIN: 8786,
-            os_ip.INTERNAL: 8786,
-        },
-    }
     service_type = 'manila'
     # manila needs a second service type as well - there is a custom connect
     # function to set both service types.
     service_type_v2 = 'manilav2'
 
     default_service = 'manila-api'
-    services = ['manila-api',
-                'manila-scheduler',
-                'manila-share',
-                'manila-data']
 
     # Note that the hsm interface is optional - defined in config.yaml
     required_relations = ['shared-db', 'amqp', 'identity-service']
 
-    restart_map = {
-        MANILA_CONF: services,
-        MANILA_API_PASTE_CONF: services,
-        MANILA_LOGGING_CONF: services,
-    }
-
     # This is the command to sync the database
     sync_cmd = ['sudo', 'manila-manage', 'db', 'sync']
 
-    # ha_resources = ['vips', 'haproxy']
-
     # Custom charm configuration
 
+    @property
+    def configured_roles(self):
+        """Return the valid roles, from the 'roles' option, that this unit has
+        in ROLES order.  If no roles are set then the unit has all of them.
+
+        :returns: list of strings: the roles of this unit
+        """
+        roles = strip_join(self.options.roles).lower().split()
+        if not roles:
+            return list(ROLES)
+        return [r for r in ROLES if r in roles]
+
+    @property
+    def invalid_roles(self):
+        """Return any roles in the 'roles' option that are not valid.
+
+        :returns: list of strings: the invalid roles
+        """
+        return [r for r in strip_join(self.options.roles).lower().split()
+                if r not in ROLES]
+
+    @property
+    def api_middleware(self):
+        """Return the valid optional API filters from the 'api-middleware'
+        option in API_MIDDLEWARE order.
+
+        :returns: list of strings: the filter names
+        """
+        names = strip_join(self.options.api_middleware).lower().split()
+        unsupported = self.unsupported_api_middleware
+        return [m for m in API_MIDDLEWARE
+                if m in names and m not in unsupported]
+
+    @property
+    def invalid_api_middleware(self):
+        """Return any filters in the 'api-middleware' option that are not
+        valid.
+
+        :returns: list of strings: the invalid filter names
+        """
+        return [m for m in strip_join(self.options.api_middleware)
+                .lower().split() if m not in API_MIDDLEWARE]
+
+    @property
+    def unsupported_api_middleware(self):
+        """Return any filters in the 'api-middleware' option that don't work
+        with the charm's release; see API_MIDDLEWARE_RELEASES.
+
+        :returns: list of strings: the unsupported filter names
+        """
+        names = [m for m in strip_join(self.options.api_middleware)
+                 .lower().split() if m in API_MIDDLEWARE_RELEASES]
+        if not names:
+            return []
+        release = ch_utils.CompareOpenStackReleases(self.release)
+        return [m for m in API_MIDDLEWARE
+                if m in names and release < API_MIDDLEWARE_RELEASES[m]]
+
+    @property
+    def profiler_hmac_key(self):
+        """Return the HMAC key for osprofiler if the 'osprofiler' API filter
+        is enabled, otherwise None.  The key is generated by the leader and
+        shared via the leader settings, as all of the API units (and the
+        clients asking for traces) need the same key; it is None on the other
+        units until the leader has set it.
+
+        :returns: string or None
+        """
+        if 'osprofiler' not in self.api_middleware:
+            return None
+        key = hookenv.leader_get(PROFILER_HMAC_KEY)
+        if not key and hookenv.is_leader():
+            key = ch_host.pwgen(32)
+            hookenv.leader_set({PROFILER_HMAC_KEY: key})
+        return key or None
+
+    @property
+    def is_api_unit(self):
+        """Return True if this unit runs the manila API.
+
+        :returns: boolean
+        """
+        return 'api' in self.configured_roles
+
+    @property
+    def wsgi_enabled(self):
+        """Return True if manila-api should be run under apache2 mod_wsgi.
+
+        :returns: boolean
+        """
+        return self.is_api_unit and bool(self.options.use_wsgi)
+
+    @property
+    def packages(self):
+        """The packages to install for the unit's roles, including apache2 and
+        mod_wsgi if the charm is configured to run the API under mod_wsgi.
+
+        :returns: list of strings: package names
+        """
+        role_packages = ['manila-{}'.format(r) for r in self.configured_roles]
+        packages = [p for p in PACKAGES
+                    if not p.startswith('manila-') or p in role_packages]
+        if self.wsgi_enabled:
+            packages.extend(WSGI_PACKAGES)
+        if self.options.use_local_memcache:
+            packages.extend(LOCAL_MEMCACHE_PACKAGES)
+        if 'osprofiler' in self.api_middleware:
+            packages.extend(PROFILER_PACKAGES)
+        return packages
+
+    @property
+    def api_service(self):
+        """Return the service that provides the manila API.
+
+        :returns: string: 'apache2' in wsgi mode, else 'manila-api'
+        """
+        if self.wsgi_enabled:
+            return 'apache2'
+        return 'manila-api'
+
+    @property
+    def services(self):
+        """The services that this unit runs for its roles.  In wsgi mode the
+        manila-api daemon is replaced by apache2, and the share role may be
+        several manila-share processes; see share_services.
+
+        :returns: list of strings: service names
+        """
+        services = []
+        for role in self.configured_roles:
+            if role == 'api':
+                services.append(self.api_service)
+            elif role == 'share':
+                services.extend(self.share_services)
+            else:
+                services.append('manila-{}'.format(role))
+        if self.options.use_local_memcache:
+            services.append('memcached')
+        return services
+
+    @property
+    def isolated_share_backends(self):
+        """Return the backends that run in their own manila-share process:
+        all of them if 'share-process-per-backend' is set, otherwise those
+        whose manila-plugin asked to be isolated.
+
+        :returns: list of strings: the backends, in configured_backends order
+        """
+        if 'share' not in self.configured_roles:
+            return []
+        backends = self.configured_backends
+        if self.options.share_process_per_backend:
+            return backends
+        config_data = self._plugin_data()['config_data']
+        return [b for b in backends
+                if config_data.get(b, {}).get(PLUGIN_ISOLATED_PROCESS_KEY)]
+
+    @property
+    def main_share_backends(self):
+        """Return the backends run by the main manila-share service.
+
+        :returns: list of strings: the backends
+        """
+        isolated = self.isolated_share_backends
+        return [b for b in self.configured_backends if b not in isolated]
+
+    @property
+    def share_services(self):
+        """The manila-share services for the unit: the main manila-share
+        service (unless every backend is isolated) and a manila-share@<backend>
+        instance for each isolated backend, so that a slow backend can't stall
+        share operations on the others.
+
+        :returns: list of strings: service names
+        """
+        isolated = self.isolated_share_backends
+        services = []
+        if not isolated or self.main_share_backends:
+            services.append('manila-share')
+        services.extend(MANILA_SHARE_INSTANCE.format(b) for b in isolated)
+        return services
+
+    @property
+    def restart_map(self):
+        """Map of configuration files to the services that need restarting
+        when they change.  api-paste.ini is only rendered on API units, and in
+        wsgi mode the apache2 vhost and the wsgi script are also rendered.
+
+        :returns: {filename: [service, ...]}
+        """
+        services = [s for s in self.services if s != 'memcached']
+        _restart_map = {
+            MANILA_CONF: services,
+            MANILA_LOGGING_CONF: services,
+        }
+        if self.is_api_unit:
+            _restart_map[MANILA_API_PASTE_CONF] = [self.api_service]
+            if 'timing' in self.api_middleware:
+                _restart_map[MANILA_REQUEST_TIMING_MODULE] = [
+                    self.api_service]
+        if self.wsgi_enabled:
+            _restart_map[MANILA_WSGI_SCRIPT] = ['apache2']
+            _restart_map[MANILA_API_VHOST_CONF] = ['apache2']
+        return _restart_map
+
+    @property
+    def api_ports(self):
+        """The API ports; only API units have any.
+
+        :returns: {service: {endpoint_type: port}}
+        """
+        if not self.is_api_unit:
+            return {}
+        return {
+            'manila-api': {
+                os_ip.PUBLIC: MANILA_API_PORT,
+                os_ip.ADMIN: MANILA_API_PORT,
+                os_ip.INTERNAL: MANILA_API_PORT,
+            },
+        }
+
+    @property
+    def ha_resources(self):
+        """The HA resources for the unit.  API units run haproxy in front of
+        manila-api and can be clustered behind a VIP via the hacluster
+        relation.  The other roles don't serve anything to load balance.
+
+        :returns: list of strings: the ha resources
+        """
+        if self.is_api_unit:
+            return ['vips', 'haproxy']
+        return []
+
+    @property
+    def api_listen_port(self):
+        """Return the port that the API service listens on.  When haproxy is
+        in front of the API this is the backend port, leaving MANILA_API_PORT
+        for the haproxy frontend.
+
+        :returns: int
+        """
+        if 'haproxy' in self.ha_resources:
+            return ch_cluster.determine_api_port(MANILA_API_PORT,
+                                                 singlenode_mode=True)
+        return MANILA_API_PORT
+
+    @property
+    def memcache_servers(self):
+        """Return the memcached servers to use for the keystone_authtoken
+        token cache.  These come from the local memcached (if enabled), the
+        'memcache' relation and the 'memcache-servers' option, in that order.
+
+        :returns: list of strings: host:port for each memcached server
+        """
+        servers = []
+        if self.options.use_local_memcache:
+            servers.append(LOCAL_MEMCACHE_SERVER)
+        adapter = self.get_adapter('memcache.available')
+        if adapter is not None:
+            servers.extend(adapter.relation.memcache_hosts())
+        servers.extend((self.options.memcache_servers or '')
+                       .replace(',', ' ').split())
+        # remove any duplicates, but keep the order stable
+        return [s for i, s in enumerate(servers) if s not in servers[:i]]
+
+    @property
+    def mutable_options(self):
+        """Return the options that the services pick up on a reload for the
+        charm's release: MUTABLE_OPTIONS from MUTABLE_OPTIONS_RELEASE, and
+        none before that.
+
+        :returns: {path: options}, as MUTABLE_OPTIONS
+        """
+        release = ch_utils.CompareOpenStackReleases(self.release)
+        if release < MUTABLE_OPTIONS_RELEASE:
+            return {}
+        return MUTABLE_OPTIONS
+
+    @contextlib.contextmanager
+    def restart_on_change(self):
+        """Restart or reload only the services whose configuration files
+        actually changed when the code in the context renders the
+        configuration.
+
+        Each file in the full restart map is hashed (see config_hashes()), and
+        the hashes are compared with those recorded (in unitdata) when its
+        services were last restarted or reloaded; if there are no recorded
+        hashes then the hashes before the render are used.  Thus identical
+        output never causes a restart, and a restart that was missed (e.g. the
+        hook errored) is picked up on the next render.
+
+        If only mutable_options changed in a file then its services are
+        reloaded rather than restarted.  If 'rolling-restarts' is set, the
+        services are restarted one at a time, waiting for each to be running
+        before moving on; otherwise they are all stopped and then all started.
+        """
+        restart_map = self.full_restart_map
+        mutable_options = self.mutable_options
+        kv = unitdata.kv()
+        hashes = kv.get(RENDERED_HASHES_KEY) or {}
+        for path in restart_map.keys():
+            if not isinstance(hashes.get(path), dict):
+                hashes[path] = config_hashes(path, mutable_options)
+        yield
+        restarts = []
+        reloads = []
+        for path, services in restart_map.items():
+            new_hashes = config_hashes(path, mutable_options)
+            if new_hashes['restart'] != hashes[path]['restart']:
+                restarts.extend(services)
+            elif new_hashes['full'] != hashes[path]['full']:
+                reloads.extend(services)
+            hashes[path] = new_hashes
+        restarts = list(collections.OrderedDict.fromkeys(restarts))
+        reloads = [s for s in collections.OrderedDict.fromkeys(reloads)
+                   if s not in restarts]
+        if restarts:
+            self.restart_services(restarts)
+        if reloads:
+            self.reload_services(reloads)
+        kv.set(RENDERED_HASHES_KEY, hashes)
+
+    def restart_services(self, services):
+        """Restart the services passed, either all at once or, if
+        'rolling-restarts' is set, one at a time.
+
+        :param services: list of strings: the services to restart in order
+        """
+        if not self.options.rolling_restarts:
+            for service_name in services:
+                ch_host.service_stop(service_name)
+            for service_name in services:
+                ch_host.service_start(service_name)
+            return
+        for service_name in services:
+            ch_host.service_restart(service_name)
+            deadline = time.time() + ROLLING_RESTART_TIMEOUT
+            while not ch_host.service_running(service_name):
+                if time.time() > deadline:
+                    hookenv.log("Service {} not running after restart"
+                                .format(service_name),
+                                level=hookenv.WARNING)
+                    break
+                time.sleep(1)
+
+    @staticmethod
+    def reload_services(services):
+        """Reload the services passed so that they pick up changes to mutable
+        options without dropping in-flight work.  A service that can't be
+        reloaded is restarted instead.
+
+        :param services: list of strings: the services to reload in order
+        """
+        for service_name in services:
+            ch_host.service_reload(service_name, restart_on_failure=True)
+
+    def install_missing_packages(self):
+        """Install any packages that are now needed by the configuration but
+        weren't installed when the charm was installed; e.g. apache2 when
+        'use-wsgi' is switched on after deployment.
+        """
+        missing = fetch.filter_installed_packages(self.packages)
+        if missing:
+            fetch.apt_install(missing, fatal=True)
+
+    def configure_api_service(self):
+        """Switch manila-api between the standalone eventlet daemon and the
+        apache2 mod_wsgi vhost according to the 'use-wsgi' option.
+
+        This needs to be called after the configuration has been rendered so
+        that the vhost configuration exists.  It only does work when the mode
+        actually changes, and only on API units.
+        """
+        if not self.is_api_unit:
+            return
+        site_enabled = os.path.exists(MANILA_API_VHOST_ENABLED)
+        if self.wsgi_enabled:
+            if site_enabled:
+                return
+            ch_host.service_pause('manila-api')
+            timed_check_call(['a2enmod', 'wsgi'])
+            timed_check_call(['a2ensite', MANILA_API_SITE])
+            ch_host.service_restart('apache2')
+        elif site_enabled:
+            timed_check_call(['a2dissite', MANILA_API_SITE])
+            ch_host.service_reload('apache2')
+            ch_host.service_resume('manila-api')
+
+    def configure_roles(self):
+        """Pause (stop and disable) the services of any roles that the unit no
+        longer has, e.g. after 'roles' changes from 'api share' to 'api', and
+        resume them if the role is added back.  The packages of removed roles
+        stay installed, so otherwise their services would keep running.
+
+        This needs to be called before configure_api_service() and
+        configure_share_processes(), which look after the apache2 vhost and
+        the manila-share processes of the roles that the unit has.
+        """
+        kv = unitdata.kv()
+        paused = kv.get(PAUSED_ROLES_KEY) or []
+        roles = self.configured_roles
+        for role in [r for r in paused if r in roles]:
+            # in wsgi mode configure_api_service() switches to apache2
+            if role != 'api' or not self.wsgi_enabled:
+                ch_host.service_resume('manila-{}'.format(role))
+        removed = [r for r in ROLES if r not in roles and r not in paused]
+        not_installed = fetch.filter_installed_packages(
+            ['manila-{}'.format(r) for r in removed])
+        for role in removed:
+            service = 'manila-{}'.format(role)
+            if service in not_installed:
+                continue
+            ch_host.service_pause(service)
+            if role == 'api' and os.path.exists(MANILA_API_VHOST_ENABLED):
+                timed_check_call(['a2dissite', MANILA_API_SITE])
+                ch_host.service_reload('apache2')
+            paused.append(role)
+        kv.set(PAUSED_ROLES_KEY, [r for r in ROLES
+                                  if r in paused and r not in roles])
+
+    def configure_share_processes(self):
+        """Set up the manila-share@<backend> instances for the isolated
+        backends, stopping any for backends that are no longer isolated, and
+        run the main manila-share service only if it has backends left.
+
+        Each instance reads manila.conf and then its own config file that
+        enables just its backend.  Those files only depend on the backend's
+        name, so an instance only needs (re)starting when it is new; changes
+        to manila.conf restart it via the restart_map.  On units without the
+        share role any instances left from when it had the role are stopped.
+        """
+        isolated = self.isolated_share_backends
+        if isolated:
+            if write_file_if_changed(MANILA_SHARE_UNIT,
+                                     MANILA_SHARE_UNIT_CONTENT):
+                timed_check_call(['systemctl', 'daemon-reload'])
+            ch_host.mkdir(MANILA_SHARE_BACKENDS_DIR, owner='manila',
+                          group='manila', perms=0o750)
+        if os.path.isdir(MANILA_SHARE_BACKENDS_DIR):
+            for filename in sorted(os.listdir(MANILA_SHARE_BACKENDS_DIR)):
+                backend, ext = os.path.splitext(filename)
+                if ext != '.conf' or backend in isolated:
+                    continue
+                ch_host.service_pause(MANILA_SHARE_INSTANCE.format(backend))
+                os.remove(os.path.join(MANILA_SHARE_BACKENDS_DIR, filename))
+        for backend in isolated:
+            service = MANILA_SHARE_INSTANCE.format(backend)
+            written = write_file_if_changed(
+                os.path.join(MANILA_SHARE_BACKENDS_DIR,
+                             '{}.conf'.format(backend)),
+                "[DEFAULT]\nenabled_share_backends = {}\n".format(backend))
+            if written or not ch_host.service_running(service):
+                # enables the instance as well as starting it.
+                ch_host.service_resume(service)
+        if 'share' not in self.configured_roles:
+            # configure_roles() looks after the main manila-share service
+            return
+        run_main = 'manila-share' in self.share_services
+        if run_main != bool(ch_host.service_running('manila-share')):
+            if run_main:
+                ch_host.service_resume('manila-share')
+            else:
+                ch_host.service_pause('manila-share')
+
     def install(self):
         """Called when the charm is being installed or upgraded.
 
         The available configuration options need to be check AFTER the charm is
         installed to check to see whether it is blocked or can go into service.
         """
-        super().install()
-        # this creates the /etc/nova directory for the
-        # neutron-openvswitch plugin if needed.
-        subprocess.check_call(["mkdir", "-p", "/etc/nova"])
-        self.assess_status()
+        with timed('charm', 'install'):
+            super().install()
+            # this creates the /etc/nova directory for the
+            # neutron-openvswitch plugin if needed.
+            timed_check_call(["mkdir", "-p", "/etc/nova"])
+            self.assess_status()
+
+    def render_configs(self, configs, adapters_instance=None):
+        """Render the configuration files passed, as the base class does,
+        recording how long each template takes to render.
+
+        :param configs: list of strings: the files to render
+        :param adapters_instance: the adapters to use as the template context;
+            defaults to self.adapters_instance
+        """
+        if adapters_instance is None:
+            adapters_instance = self.adapters_instance
+        template_loader = os_templating.get_loader('templates/', self.release)
+        with self.restart_on_change():
+            for conf in configs:
+                with timed('template', conf):
+                    ch_templating.render(source=os.path.basename(conf),
+                                         template_loader=template_loader,
+                                         target=conf,
+                                         context=adapters_instance)
+
+    # True when record_update_status() is registered to run at hook exit
+    _update_status_pending = False
+
+    def assess_status(self):
+        """Assess the status of the unit, as the base class does, and, once
+        the hook is done, record it for the update-status fast path; see
+        record_update_status().
+        """
+        super().assess_status()
+        if not self._update_status_pending:
+            self._update_status_pending = True
+            hookenv.atexit(self.record_update_status)
+
+    def record_update_status(self):
+        """Record the workload status and which of the unit's services are
+        running so that the update-status hook can skip the full dispatch
+        while they stay the same; see charm.openstack.update_status.
+        """
+        self._update_status_pending = False
+        status, message = hookenv.status_get()
+        services = self.services
+        unitdata.kv().set(update_status.UPDATE_STATUS_KEY, {
+            'status': status,
+            'message': message,
+            'services': services,
+            'running': [s for s in services if ch_host.service_running(s)],
+            'time': time.time(),
+        })
 
     def custom_assess_status_check(self):
         """Verify that the configuration provided is valid and thus the service
@@ -173,7 +1308,61 @@ class ManilaCharm(charms_openstack.charm.HAOpenStackCharm):
             there is a problem. Or (None, None) if there are no issues.
         """
         options = self.options  # tiny optimisation for less typing.
-        backends = options.computed_share_backends
+        invalid_roles = self.invalid_roles
+        if invalid_roles:
+            return ('blocked',
+                    "'roles' has invalid role(s): {}"
+                    .format(', '.join(invalid_roles)))
+        invalid_api_middleware = self.invalid_api_middleware
+        if invalid_api_middleware:
+            return ('blocked',
+                    "'api-middleware' has invalid filter(s): {}"
+                    .format(', '.join(invalid_api_middleware)))
+        unsupported_api_middleware = self.unsupported_api_middleware
+        if unsupported_api_middleware:
+            return ('blocked',
+                    "'api-middleware' filter(s) not supported on {}: {}"
+                    .format(self.release,
+                            ', '.join(unsupported_api_middleware)))
+        if 'osprofiler' in self.api_middleware and not self.profiler_hmac_key:
+            return ('waiting',
+                    "Waiting for the leader to set the profiler HMAC key")
+        if options.notification_driver not in NOTIFICATION_DRIVERS:
+            return ('blocked',
+                    "'notification-driver:{}' must be one of: {}"
+                    .format(options.notification_driver,
+                            ', '.join(NOTIFICATION_DRIVERS)))
+        if self.notification_ssl_mismatch:
+            return ('blocked',
+                    "'amqp-notifications' and 'amqp' must both use SSL, "
+                    "or neither")
+        if options.use_log_config:
+            for option in ('log-level-sqlalchemy', 'log-level-amqp',
+                           'log-level-eventlet-wsgi'):
+                level = getattr(options, option.replace('-', '_'))
+                if str(level).upper() not in LOG_LEVELS:
+                    return ('blocked',
+                            "'{}:{}' must be one of: {}"
+                            .format(option, level, ', '.join(LOG_LEVELS)))
+        # manila considers a service down if it hasn't reported in
+        # service_down_time, so this has to be longer than report_interval.
+        if options.service_down_time <= options.report_interval:
+            return ('blocked',
+                    "'service-down-time:{}' must be greater than "
+                    "'report-interval:{}'"
+                    .format(options.service_down_time,
+                            options.report_interval))
+        if 'share' not in self.configured_roles:
+            # only share units need backends to be configured.
+            return None, None
+        conflicts = self.config_conflicts_for(MANILA_CONF)
+        if conflicts:
+            return ('blocked',
+                    "Conflicting backend config: {}"
+                    .format(', '.join(
+                        "{} from {}".format(section, '/'.join(plugins))
+                        for section, plugins in conflicts.items())))
+        backends = self.configured_backends
         if not backends:
             return 'blocked', 'No share backends configured'
         default_share_backend = options.default_share_backend
@@ -185,6 +1374,39 @@ class ManilaCharm(charms_openstack.charm.HAOpenStackCharm):
                     .format(default_share_backend))
         return None, None
 
+    @property
+    def api_workers(self):
+        """Return the number of manila-api (osapi_share) worker processes,
+        scaled from the number of cpus and the 'worker-multiplier' option.
+
+        Note that manila-scheduler, manila-share and manila-data are single
+        process services and so only the API is scaled.
+
+        :returns: int, the number of workers
+        """
+        return calculate_workers(self.options.worker_multiplier,
+                                 multiprocessing.cpu_count(),
+                                 ch_host.is_container())
+
+    @property
+    def db_pool_settings(self):
+        """Return the database connection pool sizing for each manila
+        process: the options if set, otherwise oslo.db's defaults.
+
+        The sizes aren't scaled with the worker count, as each API worker has
+        its own pool; a unit can open up to (workers + 3) * (max_pool_size +
+        max_overflow) connections, counting the scheduler, share and data
+        services.
+
+        :returns: {'max_pool_size': int, 'max_overflow': int}
+        """
+        max_pool_size = self.options.database_max_pool_size
+        max_overflow = self.options.database_max_overflow
+        return {
+            'max_pool_size': max_pool_size or DEFAULT_DB_MAX_POOL_SIZE,
+            'max_overflow': max_overflow or DEFAULT_DB_MAX_OVERFLOW,
+        }
+
     def get_amqp_credentials(self):
         """Provide the default amqp username and vhost as a tuple.
 
@@ -192,6 +1414,55 @@ class ManilaCharm(charms_openstack.charm.HAOpenStackCharm):
         """
         return (self.options.rabbit_user, self.options.rabbit_vhost)
 
+    def get_notification_amqp_credentials(self):
+        """Provide the amqp username and vhost for the 'amqp-notifications'
+        relation as a tuple.
+
+        :returns (username, host): two strings to send to the amqp provider.
+        """
+        return (self.options.notification_rabbit_user,
+                self.options.notification_rabbit_vhost)
+
+    @property
+    def notification_transport_url(self):
+        """Return the oslo.messaging transport_url for the 'amqp-notifications'
+        relation, or '' if it isn't available, in which case notifications use
+        the main 'amqp' transport.
+
+        As for the main transport, the port is the relation's SSL port if
+        rabbitmq offers SSL, otherwise the default port.  Whether SSL is used
+        comes from the [oslo_messaging_rabbit] section, which follows the
+        'amqp' relation, so the status check requires the two to agree.
+
+        :returns: string
+        """
+        adapter = self.get_adapter('amqp-notifications.available')
+        if adapter is None:
+            return ''
+        amqp = adapter.relation
+        hosts = amqp.rabbitmq_hosts() or [amqp.private_address()]
+        port = amqp.ssl_port() or AMQP_DEFAULT_PORT
+        credentials = "{}:{}".format(amqp.username(), amqp.password())
+        return "rabbit://{}/{}".format(
+            ','.join("{}@{}:{}".format(credentials, host, port)
+                     for host in hosts),
+            amqp.vhost())
+
+    @property
+    def notification_ssl_mismatch(self):
+        """Return True if only one of the 'amqp' and 'amqp-notifications'
+        relations uses SSL.  oslo.messaging takes SSL for both transports from
+        the [oslo_messaging_rabbit] section, so this can't be configured.
+
+        :returns: boolean
+        """
+        notifications = self.get_adapter('amqp-notifications.available')
+        amqp = self.get_adapter('amqp.available')
+        if notifications is None or amqp is None:
+            return False
+        notifications_ssl = bool(notifications.relation.ssl_port())
+        return notifications_ssl != bool(amqp.relation.ssl_port())
+
     def get_database_setup(self):
         """Provide the default database credentials as a list of 3-tuples
 
@@ -212,30 +1483,51 @@ class ManilaCharm(charms_openstack.charm.HAOpenStackCharm):
                 hostname=hookenv.unit_private_ip(), )
         ]
 
+    @property
+    def endpoint_versions(self):
+        """The API versions to register keystone endpoints for; to register
+        another API version (e.g. v3) add it here.
+
+        :returns: list of (prefix, service, public_url, internal_url,
+            admin_url) tuples
+        """
+        return [
+            ('v1', self.service_type,
+             self.public_url, self.internal_url, self.admin_url),
+            ('v2', self.service_type_v2,
+             self.public_url_v2, self.internal_url_v2, self.admin_url_v2),
+        ]
+
     def register_endpoints(self, keystone):
-        """Custom function to register the TWO keystone endpoints that this
-        charm requires.  'charm' and 'charmv2'.
+        """Custom function to register the keystone endpoints that this charm
+        requires, one for each of the endpoint_versions; e.g. 'manila' and
+        'manilav2'.
+
+        All of the endpoints are sent in a single relation write, and only if
+        they differ from what this unit has already published, so that
+        keystone doesn't see repeated relation changes for the same
+        endpoints.
+
+        Only units with the 'api' role register endpoints.
 
         :param keystone: the keystone relation on which to setup the endpoints
         """
-        # regsiter the first endpoint
-        self._custom_register_endpoints(keystone, 'v1',
-                                        self.service_type,
-                                        self.region,
-                                        self.public_url,
-                                        self.internal_url,
-                                        self.admin_url)
-        # regsiter the second endpoint
-        self._custom_register_endpoints(keystone, 'v2',
-                                        self.service_type_v2,
-                                        self.region,
-                                        self.public_url_v2,
-                                        self.internal_url_v2,
-                                        self.admin_url_v2)
+        if not self.is_api_unit:
+            return
+        relation_info = {}
+        for (prefix, service, public_url, internal_url,
+                admin_url) in self.endpoint_versions:
+            relation_info.update(self._endpoint_relation_info(
+                prefix, service, self.region,
+                public_url, internal_url, admin_url))
+        if self._endpoints_published(relation_info):
+            return
+        keystone.set_local(**relation_info)
+        keystone.set_remote(**relation_info)
 
     @staticmethod
-    def _custom_register_endpoints(keystone, prefix, service, region,
-                                   public_url, internal_url, admin_url):
+    def _endpoint_relation_info(prefix, service, region,
+                                public_url, internal_url, admin_url):
         """Custom function to enable registering of multiple endpoints.
 
         Keystone charm understands multiple endpoints if they are prefixed with
@@ -244,23 +1536,121 @@ class ManilaCharm(charms_openstack.charm.HAOpenStackCharm):
         function duplicates part of that functionality but enables the
         'multiple' endpoints to be set
 
-        :param keystone: the relation that is keystone.
         :param prefix: the prefix to prepend to '_<var>'
         :param service: the service to set
         :param region: the OS region
         :param public_url: the public_url
         :param internal_url: the internal_url
         :prarm admin_url: the admin url.
+        :returns: {key: value}: the relation data for the endpoint
         """
-        relation_info = {
+        return {
             '{}_service'.format(prefix): service,
             '{}_public_url'.format(prefix): public_url,
             '{}_internal_url'.format(prefix): internal_url,
             '{}_admin_url'.format(prefix): admin_url,
             '{}_region'.format(prefix): region,
         }
-        keystone.set_local(**relation_info)
-        keystone.set_remote(**relation_info)
+
+    @staticmethod
+    def _endpoints_published(relation_info):
+        """Return True if this unit has already published relation_info on
+        every identity-service relation.
+
+        This reads back the unit's own relation settings rather than keeping a
+        separate record, so that a new (or re-made) relation always gets the
+        endpoints.
+
+        :param relation_info: {key: value}: the endpoint relation data
+        :returns: boolean
+        """
+        rids = hookenv.relation_ids('identity-service')
+        if not rids:
+            return False
+        local_unit = hookenv.local_unit()
+        for rid in rids:
+            published = hookenv.relation_get(rid=rid, unit=local_unit) or {}
+            for key, value in relation_info.items():
+                if published.get(key) != str(value):
+                    return False
+        return True
+
+    @staticmethod
+    def render_fingerprint():
+        """Return everything that can go into the rendered configuration: the
+        charm config, the units on the RENDER_RELATIONS, the remote data of
+        the current hook's relation, the leader settings, the unit's address
+        and the charm's own code and templates.  If this hasn't changed then
+        rendering again would produce the same files, so the render can be
+        skipped.
+
+        Remote relation data can only change in that relation's hooks, so
+        rather than reading the data of every unit on every relation, only
+        the data the interface has already read for the current hook is
+        included; any hook on a RENDER_RELATIONS relation where that data
+        differs from the last fingerprint renders again.
+
+        :returns: dict, JSON serialisable
+        """
+        remote = None
+        remote_unit = hookenv.remote_unit()
+        if remote_unit and hookenv.relation_type() in RENDER_RELATIONS:
+            remote = {
+                'relation_id': hookenv.relation_id(),
+                'unit': remote_unit,
+                'data': hookenv.relation_get(),
+            }
+        return {
+            'config': dict(hookenv.config()),
+            'units': {name: relation_units(name)
+                      for name in RENDER_RELATIONS},
+            'remote': remote,
+            'leader': hookenv.leader_get(),
+            'address': hookenv.unit_private_address(),
+            'charm': charm_files_hash(),
+        }
+
+    def db_sync_marker(self):
+        """Return what the database would be synced for: the installed manila
+        version, the alembic head(s) it expects and the database itself.
+
+        :returns: {'version': string, 'heads': [string], 'database': string}
+        """
+        database = self.options.database
+        adapter = self.get_adapter('shared-db.available')
+        if adapter is not None:
+            database = "{}/{}".format(adapter.relation.db_host(), database)
+        return {
+            'version': installed_version('manila-common'),
+            'heads': alembic_heads(),
+            'database': database,
+        }
+
+    def db_sync(self, force=False):
+        """Sync the database using self.sync_cmd, but only on the leader and
+        only if the manila version, the alembic head(s) or the database have
+        changed since the last sync (as recorded in the leader settings).
+        This avoids running a slow 'manila-manage db sync' on every hook.
+
+        As in the base class, after a sync the 'db-sync-done' leader setting
+        is set and the services are restarted so that they use the new schema.
+
+        :param force: boolean, sync even if nothing has changed
+        :returns: boolean, True if the sync was done
+        """
+        if not hookenv.is_leader():
+            return False
+        marker = self.db_sync_marker()
+        last_marker = hookenv.leader_get(DB_SYNC_KEY)
+        if not force and last_marker and json.loads(last_marker) == marker:
+            return False
+        timed_check_call(self.sync_cmd)
+        hookenv.leader_set({
+            DB_SYNC_KEY: json.dumps(marker, sort_keys=True),
+            'db-sync-done': True,
+        })
+        self.restart_all()
+        return True
 
     @property
     def public_url(self):
@@ -286,49 +1676,174 @@ class ManilaCharm(charms_openstack.charm.HAOpenStackCharm):
     def internal_url_v2(self):
         return super().internal_url + "/v2/%(tenant_id)s"
 
+    @property
+    def scheduler_filters(self):
+        """Return the scheduler filters: those from the
+        'scheduler-default-filters' option followed by any extra filters that
+        the configured manila-plugin backends ask for.  If the option isn't
+        set and a plugin asks for filters, manila's default filters are used
+        as the base list.
+
+        :returns: list of strings: the filters, or [] for manila's defaults
+        """
+        filters = ((self.options.scheduler_default_filters or '')
+                   .replace(',', ' ').split())
+        plugin_data = self._plugin_data()
+        included = self._plugin_config(MANILA_CONF)['included']
+        plugin_filters = []
+        for plugin, data in sorted(plugin_data['config_data'].items()):
+            if plugin not in included:
+                continue
+            plugin_filters.extend(data.get(PLUGIN_SCHEDULER_FILTERS_KEY, []))
+        if plugin_filters and not filters:
+            filters = list(MANILA_DEFAULT_SCHEDULER_FILTERS)
+        return list(collections.OrderedDict.fromkeys(
+            filters + plugin_filters))
+
     @property
     def configured_backends(self):
         """Return a list of configured backends that come from the associated
-        'manila-share.available' state..
+        'manila-plugin.available' state.
 
-        TODO: Note that the first backend that becomes 'available' will set
-        this state.  It's not clear how multiple backends will interact yet!
+        A backend whose plugin has not yet provided any or complete
+        manila.conf configuration, or whose sections conflict with another
+        plugin's, is left out; see _plugin_config().
 
         :returns: list of strings: backend sections that are configured.
         """
-        adapter = self.get_adapter('manila-plugin.available')
-        if adapter is None:
-            return []
-        # adapter.names is a property that provides a list of backend manila
-        # plugin names for the sections
-        return adapter.relation.names
+        plugin_data = self._plugin_data()
+        included = self._plugin_config(MANILA_CONF)['included']
+        names = sorted(plugin_data['names'])
+        if '' in included:
+            # single plugin with older interface data; see
+            # per_plugin_config_data()
+            return names
+        return [n for n in names if n in included]
 
     def config_lines_for(self, config_file):
         """Return the list of configuration lines for `config_file` as returned
-        by manila-plugin backend charms.
-
-        TODO: Note that it is not clear how we get this from multiple plugin
-        charms -- still to be worked out
+        by the manila-plugin backend charms; see _plugin_config().
 
         :param config_file: string, filename for configuration lines
         :returns: list of strings: config lines for `config_file`
         """
-        adapter = self.get_adapter('manila-plugin.available')
-        if adapter is not None:
-            # get the configuration data for all plugins
-            config_data = adapter.relation.get_configuration_data()
-            if config_file not in config_data:
-                return []
-            config_lines = []
-            for section, lines in config_data[config_file].items():
-                if section == 'complete':
-                    # if the 'lines' is not truthy, then this conf isn't
-                    # complete, so just break out.
-                    if not lines:
-                        break
-                    continue
-                config_lines.append(section)
-                config_lines.extend(lines)
-                config_lines.append('')
-            return config_lines
-        return []
+        return self._plugin_config(config_file)['lines']
+
+    def config_conflicts_for(self, config_file):
+        """Return the sections in `config_file` that more than one
+        manila-plugin backend charm tried to provide.
+
+        :param config_file: string, filename for configuration lines
+        :returns: {section: [plugin, ...]}: the plugins providing each
+            conflicting section, in the order they were merged.
+        """
+        return self._plugin_config(config_file)['conflicts']
+
+    def _plugin_config(self, config_file):
+        """Merge the configuration for `config_file` from all of the
+        manila-plugin backend charms.
+
+        Plugins are merged in name order and the sections from each plugin in
+        section order, so that the output is stable between hooks.  A plugin
+        that hasn't marked the config as 'complete' is excluded, as is a
+        plugin that provides a section that an earlier plugin already
+        provided; the conflict is recorded for the status check.  Neither
+        stops the other plugins' configuration being used.  The plugins whose
+        configuration is used are 'included'; a plugin that provides nothing
+        for the file is in neither list.
+
+        The result is memoised along with the rest of the plugin data; see
+        _plugin_data().
+
+        :param config_file: string, filename for configuration lines
+        :returns: {'lines': [line, ...],
+                   'included': [plugin, ...],
+                   'excluded': [plugin, ...],
+                   'conflicts': {section: [plugin, ...]}}
+        """
+        plugin_data = self._plugin_data()
+        if config_file in plugin_data['files']:
+            return plugin_data['files'][config_file]
+        lines = []
+        included = []
+        excluded = []
+        conflicts = collections.OrderedDict()
+        providers = {}
+        for plugin, data in sorted(plugin_data['config_data'].items()):
+            file_data = data.get(config_file)
+            if not file_data:
+                continue
+            if not file_data.get('complete'):
+                excluded.append(plugin)
+                continue
+            sections = sorted(s for s in file_data.keys() if s != 'complete')
+            clashes = [s for s in sections if s in providers]
+            if clashes:
+                for section in clashes:
+                    conflicts.setdefault(
+                        section, [providers[section]]).append(plugin)
+                excluded.append(plugin)
+                continue
+            included.append(plugin)
+            for section in sections:
+                providers[section] = plugin
+                lines.append(section)
+                lines.extend(file_data[section])
+                lines.append('')
+        plugin_config = {
+            'lines': lines,
+            'included': included,
+            'excluded': excluded,
+            'conflicts': conflicts,
+        }
+        plugin_data['files'][config_file] = plugin_config
+        return plugin_config
+
+    # Memoised manila-plugin relation data; see _plugin_data()
+    _plugin_data_cache = None
+
+    @staticmethod
+    def _plugin_data_key():
+        """Return a key that identifies the current manila-plugin relation
+        data.  The remote data can't change during a hook, but the
+        conversations (and thus the data) behind the state can as units join
+        and depart, and these are recorded in the state's value.
+
+        :returns: string
+        """
+        return json.dumps(
+            charms.reactive.bus.get_state(MANILA_PLUGIN_AVAILABLE),
+            sort_keys=True)
+
+    def _plugin_data(self):
+        """Return the backend names and configuration data from the
+        manila-plugin relation.
+
+        Looking these up means building the relation adapter and decoding
+        the configuration data for every plugin, and they are needed by
+        several config properties during a render and again by the status
+        check.  They are memoised on the instance, and so for the hook, until
+        the key from _plugin_data_key() changes.
+
+        :returns: {'names': [backend, ...],
+                   'config_data': {plugin: {config_file: {section: lines}}},
+                   'files': {config_file: <see _plugin_config()>}}
+        """
+        key = self._plugin_data_key()
+        cache = self._plugin_data_cache
+        if cache is not None and cache[0] == key:
+            return cache[1]
+        adapter = self.get_adapter(MANILA_PLUGIN_AVAILABLE)
+        if adapter is None:
+            plugin_data = {'names': [], 'config_data': {}, 'files': {}}
+        else:
+            # adapter.names is a property that provides a list of backend
+            # manila plugin names for the sections
+            plugin_data = {
+                'names': adapter.relation.names,
+                'config_data': per_plugin_config_data(
+                    adapter.relation.get_configuration_data()),
+                'files': {},
+            }
+        self._plugin_data_cache = (key, plugin_data)
+        return plugin_data
@@ -0,0 +1,111 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The fast path for the update-status hook.
+#
+# The full reactive dispatch (the reactive framework, charms_openstack and
+# the charm's library, then every handler's state evaluation) is only needed
+# on update-status if something that the status depends on has changed.  At
+# the end of each full hook, ManilaCharm.record_update_status() records the
+# workload status and which of the unit's services were running; if the unit
+# was active then the update-status hook uses unchanged() to check just the
+# services against that record, and only does the full dispatch if they
+# differ.  Any other status may be waiting on something else (e.g. a relation
+# or the leader), so it always gets the full dispatch.
+#
+# This module must only use the standard library, as the point is to not
+# import anything else.
+from __future__ import absolute_import
+
+import json
+import os
+import sqlite3
+import subprocess
+import time
+
+# unitdata key for the record; see ManilaCharm.record_update_status()
+UPDATE_STATUS_KEY = 'manila.update-status'
+
+# Do the full dispatch at least this often (in seconds) anyway, so that the
+# parts of the status that don't depend on the services are re-checked.
+MAX_AGE = 3600
+
+
+def unit_state_db():
+    """Return the path of the charmhelpers unitdata database.
+
+    :returns: string
+    """
+    return os.environ.get(
+        'UNIT_STATE_DB',
+        os.path.join(os.environ.get('CHARM_DIR', ''), '.unit-state.db'))
+
+
+def recorded_status(db_path=None):
+    """Return the record from the last full hook, read directly from the
+    unitdata database rather than via charmhelpers.
+
+    :param db_path: string, the database; defaults to unit_state_db()
+    :returns: {'status', 'message', 'services', 'running', 'time'} or None
+        if there isn't a record.
+    """
+    db_path = db_path or unit_state_db()
+    if not os.path.exists(db_path):
+        return None
+    try:
+        conn = sqlite3.connect('file:{}?mode=ro'.format(db_path), uri=True)
+        try:
+            row = conn.execute('SELECT data FROM kv WHERE key=?',
+                               (UPDATE_STATUS_KEY, )).fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+    if row is None:
+        return None
+    return json.loads(row[0])
+
+
+def service_running(service):
+    """Return True if the systemd service is active.
+
+    :param service: string, the service name
+    :returns: boolean
+    :raises: OSError if systemctl isn't available
+    """
+    return subprocess.call(['systemctl', '--quiet', 'is-active',
+                            service]) == 0
+
+
+def unchanged(record=None, now=None):
+    """Return True if the unit was active at the end of the last full hook,
+    the services that were running then are still the ones running, and that
+    was less than MAX_AGE ago; i.e. if the update-status hook can skip the
+    full dispatch.
+
+    :param record: the recorded status; defaults to recorded_status()
+    :param now: float, the current time; defaults to time.time()
+    :returns: boolean
+    """
+    if record is None:
+        record = recorded_status()
+    if not record or record.get('status') != 'active':
+        return False
+    if (now or time.time()) - record.get('time', 0) > MAX_AGE:
+        return False
+    try:
+        running = [s for s in record['services'] if service_running(s)]
+    except OSError:
+        return False
+    return running == record['running']
@@ -16,11 +16,12 @@
 from __future__ import absolute_import
 
 import charms.reactive
+import charms.reactive.helpers
 import charms_openstack.charm
 
 # This charm's library contains all of the handler code associated with
 # manila -- we need to import it to get the definitions for the charm.
-import charm.openstack.manila  # noqa
+import charm.openstack.manila
 
 
 # Use the charms.openstack defaults for common states and hooks
@@ -31,7 +32,7 @@ charms_openstack.charm.use_defaults(
     # 'identity-service.connected',
     'identity-service.available',  # enables SSL support
     # 'config.changed',
-    # 'update-status'
+    'update-status',  # the hook only dispatches if the services changed
 )
 
 
@@ -42,19 +43,30 @@ def register_endpoints(keystone):
     as it needs to register multiple endpoints, and thus needs a custom
     function in the charm.
     """
-    with charms_openstack.charm.provide_charm_instance() as manila_charm:
+    with charm.openstack.manila.timed('handler', 'register_endpoints'), \
+            charms_openstack.charm.provide_charm_instance() as manila_charm:
         manila_charm.register_endpoints(keystone)
         manila_charm.assess_status()
 
 
+@charms.reactive.when('amqp-notifications.connected')
+def setup_amqp_notifications(amqp):
+    """Request access to the (separate) notifications rabbitmq when the
+    amqp-notifications relation connects.
+    """
+    with charms_openstack.charm.provide_charm_instance() as manila_charm:
+        amqp.request_access(*manila_charm.get_notification_amqp_credentials())
+
+
 @charms.reactive.when('identity-service.connected',
                       'manila-plugin.connected')
 def share_to_manila_plugins_auth(keystone, manila_plugin):
     """When we have the identity-service and (a) backend plugin, share the auth
     plugin with the back end.
 
-    TODO: if we have multiple manila-plugin's does this get called for each
-    relation that gets connected?
+    The data is only sent when it, or the set of plugin units, changes so
+    that steady state hooks (e.g. update-status) don't cause a cascade of
+    relation-changed hooks on the plugins.
     """
     data = {
         'username': keystone.service_username(),
@@ -72,20 +84,26 @@ def share_to_manila_plugins_auth(keystone, manila_plugin):
                              port=keystone.auth_port())),
         'auth_type': 'password',
     }
-    # Set the auth data to be the same for all plugins
-    manila_plugin.set_authentication_data(data)
+    # Set the auth data to be the same for all plugins, but only if it, or
+    # the plugin units that should have it, have changed; each set causes a
+    # relation-changed hook on every plugin unit.
+    if charms.reactive.helpers.data_changed(
+            'manila-plugin.authentication-data',
+            {'data': data,
+             'units': charm.openstack.manila.relation_units('manila-plugin')}):
+        manila_plugin.set_authentication_data(data)
 
 
 @charms.reactive.when('shared-db.available',
                       'manila.config.rendered')
 def maybe_do_syncdb(shared_db):
     """Sync the database when the shared-db becomes available.  Note that the
-    charms.openstack.OpenStackCharm.db_sync() default method checks that only
-    the leader does the sync.  As manila uses alembic to do the database
-    migration, it doesn't matter if it's done more than once, so we don't have
-    to gate it in the charm.
+    ManilaCharm.db_sync() method checks that only the leader does the sync,
+    and only when the manila version or schema head has changed since the last
+    sync.  The 'force-db-sync' action can be used to sync regardless.
     """
-    with charms_openstack.charm.provide_charm_instance() as manila_charm:
+    with charm.openstack.manila.timed('handler', 'maybe_do_syncdb'), \
+            charms_openstack.charm.provide_charm_instance() as manila_charm:
         manila_charm.db_sync()
 
 
@@ -95,13 +113,38 @@ def maybe_do_syncdb(shared_db):
 def render_stuff(*args):
     """Render the configuration for Manila when all the interfaces are
     available.
+
+    This is skipped entirely if nothing that goes into the configuration has
+    changed since the last render (see ManilaCharm.render_fingerprint()), so
+    that update-status and unrelated relation hooks don't re-render and
+    re-check everything.
     """
-    with charms_openstack.charm.provide_charm_instance() as manila_charm:
+    with charm.openstack.manila.timed('handler', 'render_stuff'), \
+            charms_openstack.charm.provide_charm_instance() as manila_charm:
+        changed = charms.reactive.helpers.data_changed(
+            charm.openstack.manila.RENDER_FINGERPRINT_KEY,
+            manila_charm.render_fingerprint())
+        if not changed and charms.reactive.is_state('manila.config.rendered'):
+            return
+        manila_charm.install_missing_packages()
         manila_charm.render_with_interfaces(args)
+        manila_charm.configure_roles()
+        manila_charm.configure_api_service()
+        manila_charm.configure_share_processes()
         manila_charm.assess_status()
         charms.reactive.set_state('manila.config.rendered')
 
 
+@charms.reactive.when('ha.connected')
+def cluster_connected(hacluster):
+    """Configure the HA resources (the VIP(s) and haproxy) for the manila-api
+    service when the hacluster subordinate is related.
+    """
+    with charms_openstack.charm.provide_charm_instance() as manila_charm:
+        manila_charm.configure_ha_resources(hacluster)
+        manila_charm.assess_status()
+
+
 @charms.reactive.when('config.changed',
                       'shared-db.available',
                       'identity-service.available',
@@ -112,4 +155,5 @@ def config_changed(*args):
     the configuration files won't be written until all the interfaces are
     available and STAY available.
     """
-    render_stuff(*args)
+    with charm.openstack.manila.timed('handler', 'config_changed'):
+        render_stuff(*args)
@@ -0,0 +1,81 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This file is managed by the manila charm; it is the 'timing' filter in
+# /etc/manila/api-paste.ini.  Local changes will be overwritten.
+
+"""Paste filter that logs the duration, method, path template and status of
+each manila API request at INFO, and at WARNING if the request took longer
+than 'slow_threshold' seconds (0 disables the warnings).
+"""
+
+import logging
+import re
+import time
+
+LOG = logging.getLogger('manila.api.request_timing')
+
+# project ids and resource ids, for when the route isn't known
+ID_RE = re.compile(r'/(?:[0-9a-fA-F]{32}|'
+                   r'[0-9a-fA-F]{8}-(?:[0-9a-fA-F]{4}-){3}[0-9a-fA-F]{12})'
+                   r'(?=/|$)')
+
+
+def path_template(environ):
+    """Return the path of the request with the ids replaced by the names of
+    the route's parameters, e.g. /v2/{project_id}/shares/{id}, so that
+    requests for different resources can be grouped.
+
+    :param environ: the WSGI environ, after the request has been routed
+    :returns: string
+    """
+    route = environ.get('routes.route')
+    if route is not None and getattr(route, 'routepath', None):
+        return environ.get('SCRIPT_NAME', '') + route.routepath
+    path = environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+    return ID_RE.sub('/{id}', path)
+
+
+class RequestTiming(object):
+
+    def __init__(self, application, slow_threshold=0):
+        self.application = application
+        self.slow_threshold = float(slow_threshold or 0)
+
+    def __call__(self, environ, start_response):
+        status = []
+
+        def _start_response(response_status, headers, exc_info=None):
+            status.append(response_status.split(' ', 1)[0])
+            return start_response(response_status, headers, exc_info)
+
+        start = time.time()
+        try:
+            return self.application(environ, _start_response)
+        finally:
+            duration = time.time() - start
+            slow = self.slow_threshold and duration > self.slow_threshold
+            LOG.log(logging.WARNING if slow else logging.INFO,
+                    "%s%s %s %s %.3fs",
+                    "Slow request: " if slow else "",
+                    environ.get('REQUEST_METHOD'),
+                    path_template(environ),
+                    status[0] if status else '-',
+                    duration)
+
+
+def filter_factory(global_conf, **local_conf):
+    def _filter(application):
+        return RequestTiming(application, **local_conf)
+    return _filter
@@ -0,0 +1,143 @@
+# Copyright 2016 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+
+import charm.openstack.update_status as update_status
+
+import charms_openstack.test_utils as test_utils
+
+# The most that the fast path may take, from the start of the import of
+# update_status to the decision, in seconds.  It is typically a few ms; this
+# is generous so that the test isn't flaky on a loaded machine, but is still
+# a fraction of the cost of importing the reactive framework and
+# charms_openstack.
+FAST_PATH_BUDGET = 0.5
+
+
+class TestUpdateStatus(test_utils.PatchHelper):
+
+    def setUp(self):
+        super().setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.db_path = os.path.join(self.tmpdir, '.unit-state.db')
+
+    def _write_record(self, record):
+        # the charmhelpers unitdata schema
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('CREATE TABLE IF NOT EXISTS kv ('
+                     'key text, data text, primary key (key))')
+        conn.execute('REPLACE INTO kv (key, data) VALUES (?, ?)',
+                     (update_status.UPDATE_STATUS_KEY, json.dumps(record)))
+        conn.commit()
+        conn.close()
+
+    def test_unit_state_db(self):
+        self.patch_object(update_status.os, 'environ',
+                          new={'CHARM_DIR': '/var/lib/juju/charm'})
+        self.assertEqual(update_status.unit_state_db(),
+                         '/var/lib/juju/charm/.unit-state.db')
+        update_status.os.environ['UNIT_STATE_DB'] = '/tmp/state.db'
+        self.assertEqual(update_status.unit_state_db(), '/tmp/state.db')
+
+    def test_recorded_status(self):
+        self.assertEqual(update_status.recorded_status(self.db_path), None)
+        self._write_record({'other': 'data'})
+        self.assertEqual(update_status.recorded_status(self.db_path),
+                         {'other': 'data'})
+        with open(self.db_path, 'w') as f:
+            f.write('not a database')
+        self.assertEqual(update_status.recorded_status(self.db_path), None)
+
+    def test_service_running(self):
+        self.patch_object(update_status.subprocess, 'call')
+        self.call.return_value = 0
+        self.assertTrue(update_status.service_running('manila-api'))
+        self.call.assert_called_once_with(
+            ['systemctl', '--quiet', 'is-active', 'manila-api'])
+        self.call.return_value = 3
+        self.assertFalse(update_status.service_running('manila-api'))
+
+    def test_unchanged(self):
+        self.patch_object(update_status, 'recorded_status')
+        self.patch_object(update_status, 'service_running')
+        self.recorded_status.return_value = None
+        self.assertFalse(update_status.unchanged())
+        record = {
+            'status': 'active',
+            'message': 'Unit is ready',
+            'services': ['manila-api', 'manila-share'],
+            'running': ['manila-api', 'manila-share'],
+            'time': 1000.0,
+        }
+        self.service_running.return_value = True
+        self.assertTrue(update_status.unchanged(record, now=1010.0))
+        # a service has stopped
+        self.service_running.side_effect = lambda s: s == 'manila-api'
+        self.assertFalse(update_status.unchanged(record, now=1010.0))
+        # or started
+        record['running'] = ['manila-api']
+        self.assertTrue(update_status.unchanged(record, now=1010.0))
+        # the record is too old
+        self.assertFalse(update_status.unchanged(
+            record, now=1000.0 + update_status.MAX_AGE + 1))
+        # no systemctl
+        self.service_running.side_effect = OSError
+        self.assertFalse(update_status.unchanged(record, now=1010.0))
+        # the unit wasn't active, e.g. it was waiting on a relation
+        self.service_running.side_effect = lambda s: s == 'manila-api'
+        self.assertTrue(update_status.unchanged(record, now=1010.0))
+        record['status'] = 'blocked'
+        self.assertFalse(update_status.unchanged(record, now=1010.0))
+
+    def test_fast_path_startup(self):
+        # Run the fast path in a fresh interpreter, as the update-status hook
+        # does, against a record with no services so that the decision
+        # doesn't depend on this machine's services.
+        self._write_record({
+            'status': 'active',
+            'message': 'Unit is ready',
+            'services': [],
+            'running': [],
+            'time': 4102444800.0,  # 2100-01-01
+        })
+        code = (
+            "import sys, time\n"
+            "start = time.time()\n"
+            "sys.path.append('src/lib')\n"
+            "import charm.openstack.update_status as update_status\n"
+            "unchanged = update_status.unchanged(now=4102444800.0)\n"
+            "print(time.time() - start)\n"
+            "print(unchanged)\n"
+            "print(' '.join(sorted(sys.modules)))\n")
+        env = dict(os.environ, UNIT_STATE_DB=self.db_path)
+        output = subprocess.check_output(
+            [sys.executable, '-c', code], env=env).decode().splitlines()
+        elapsed, unchanged, modules = output[0], output[1], output[2].split()
+        self.assertEqual(unchanged, 'True')
+        for module in ('charmhelpers', 'charms', 'charms.reactive',
+                       'charms_openstack', 'charm.openstack.manila', 'yaml',
+                       'jinja2'):
+            self.assertNotIn(module, modules)
+        self.assertLess(float(elapsed), FAST_PATH_BUDGET)
@@ -30,6 +30,7 @@ class TestRegisteredHooks(test_utils.TestRegisteredHooks):
             'amqp.connected',
             'shared-db.connected',
             'identity-service.available',  # enables SSL support
+            'update-status',
         ]
         hook_set = {
             'when': {
@@ -41,6 +42,8 @@ class TestRegisteredHooks(test_utils.TestRegisteredHooks):
                                                  'manila-plugin.connected', ),
                 'maybe_do_syncdb': ('shared-db.available',
                                     'manila.config.rendered', ),
+                'cluster_connected': ('ha.connected', ),
+                'setup_amqp_notifications': ('amqp-notifications.connected', ),
                 'config_changed': ('config.changed',
                                    'shared-db.available',
                                    'identity-service.available',
@@ -69,6 +72,44 @@ class TestRenderStuff(test_utils.PatchHelper):
         manila_charm.register_endpoints.assert_called_once_with('keystone')
         manila_charm.assess_status.assert_called_once_with()
 
+    def test_share_to_manila_plugins_auth(self):
+        self.patch('charms.reactive.helpers.data_changed',
+                   name='data_changed')
+        self.patch_object(handlers.charm.openstack.manila, 'relation_units')
+        self.relation_units.return_value = ['plugin/0']
+        keystone = mock.MagicMock()
+        keystone.service_username.return_value = 'user'
+        keystone.service_password.return_value = 'pass'
+        keystone.service_protocol.return_value = 'http'
+        keystone.service_host.return_value = 'host1'
+        keystone.service_port.return_value = '5000'
+        keystone.auth_protocol.return_value = 'https'
+        keystone.auth_host.return_value = 'host2'
+        keystone.auth_port.return_value = '35357'
+        manila_plugin = mock.MagicMock()
+        data = {
+            'username': 'user',
+            'password': 'pass',
+            'project_domain_id': 'default',
+            'project_name': 'services',
+            'user_domain_id': 'default',
+            'auth_uri': 'http://host1:5000',
+            'auth_url': 'https://host2:35357',
+            'auth_type': 'password',
+        }
+        self.data_changed.return_value = True
+        handlers.share_to_manila_plugins_auth(keystone, manila_plugin)
+        manila_plugin.set_authentication_data.assert_called_once_with(data)
+        self.data_changed.assert_called_once_with(
+            'manila-plugin.authentication-data',
+            {'data': data, 'units': ['plugin/0']})
+        self.relation_units.assert_called_once_with('manila-plugin')
+        # unchanged, so not sent again
+        manila_plugin.reset_mock()
+        self.data_changed.return_value = False
+        handlers.share_to_manila_plugins_auth(keystone, manila_plugin)
+        manila_plugin.set_authentication_data.assert_not_called()
+
     def test_maybe_do_syncdb(self):
         manila_charm = self._patch_provide_charm_instance()
         handlers.maybe_do_syncdb('shared_db')
@@ -76,14 +117,61 @@ class TestRenderStuff(test_utils.PatchHelper):
 
     def test_render_stuff(self):
         manila_charm = self._patch_provide_charm_instance()
+        manila_charm.render_fingerprint.return_value = {'config': {}}
         self.patch('charms.reactive.set_state', name='set_state')
+        self.patch('charms.reactive.is_state', name='is_state')
+        self.patch('charms.reactive.helpers.data_changed',
+                   name='data_changed')
+        self.data_changed.return_value = True
+        self.is_state.return_value = True
 
         handlers.render_stuff('arg1', 'arg2')
+        self.data_changed.assert_called_once_with(
+            'manila.render-fingerprint', {'config': {}})
+        manila_charm.install_missing_packages.assert_called_once_with()
         manila_charm.render_with_interfaces.assert_called_once_with(
             ('arg1', 'arg2', ))
+        manila_charm.configure_roles.assert_called_once_with()
+        manila_charm.configure_api_service.assert_called_once_with()
+        manila_charm.configure_share_processes.assert_called_once_with()
         manila_charm.assess_status.assert_called_once_with()
         self.set_state.assert_called_once_with('manila.config.rendered')
 
+    def test_render_stuff_unchanged(self):
+        manila_charm = self._patch_provide_charm_instance()
+        self.patch('charms.reactive.set_state', name='set_state')
+        self.patch('charms.reactive.is_state', name='is_state')
+        self.patch('charms.reactive.helpers.data_changed',
+                   name='data_changed')
+        self.data_changed.return_value = False
+        self.is_state.return_value = True
+        handlers.render_stuff('arg1', 'arg2')
+        manila_charm.render_with_interfaces.assert_not_called()
+        manila_charm.assess_status.assert_not_called()
+        self.set_state.assert_not_called()
+        # but it is rendered if it never has been
+        self.is_state.return_value = False
+        handlers.render_stuff('arg1', 'arg2')
+        self.is_state.assert_called_with('manila.config.rendered')
+        manila_charm.render_with_interfaces.assert_called_once_with(
+            ('arg1', 'arg2', ))
+        self.set_state.assert_called_once_with('manila.config.rendered')
+
+    def test_cluster_connected(self):
+        manila_charm = self._patch_provide_charm_instance()
+        handlers.cluster_connected('hacluster')
+        manila_charm.configure_ha_resources.assert_called_once_with(
+            'hacluster')
+        manila_charm.assess_status.assert_called_once_with()
+
+    def test_setup_amqp_notifications(self):
+        manila_charm = self._patch_provide_charm_instance()
+        manila_charm.get_notification_amqp_credentials.return_value = (
+            'user', 'vhost')
+        amqp = mock.MagicMock()
+        handlers.setup_amqp_notifications(amqp)
+        amqp.request_access.assert_called_once_with('user', 'vhost')
+
     def test_config_changed(self):
         self.patch_object(handlers, 'render_stuff')
         handlers.config_changed('hello', 'there')